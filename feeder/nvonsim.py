@@ -1,183 +1,251 @@
 import subprocess
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import os
 import argparse
 import sys
+import matplotlib
+# Graphs are only saved to files, use the non-interactive backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-import time
 import datetime
-from collections import OrderedDict
+import numpy as np
 import json
 import shutil
+from pathlib import Path
+from itertools import repeat
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Entry point of the NVON Simulator, run from the current working directory
+NVON_MAIN = "main.py"
+
+
+def loadJson(filename: str | Path):
+    """ Loads a JSON file. Uses orjson when it is installed, the json module otherwise.
+        Args:
+            filename: the JSON file to load
+
+        Returns: the deserialized JSON document.
+    """
+    if orjson is not None:
+        with open(filename, "rb") as fp:
+            return orjson.loads(fp.read())
+    with open(filename) as fp:
+        return json.load(fp)
+
+def appendJson(obj: dict, filename: str | Path):
+    """ Adds the items of a dict to the JSON object stored in a file. The items already in the file
+        are not rewritten, the new ones are spliced in before its closing brace. If a key appears
+        twice, the later value wins when the file is loaded, as with dict.update.
+        Args:
+            obj: the dict to add
+            filename: the JSON file, created if it does not exist
+    """
+    data = orjson.dumps(obj) if orjson is not None else json.dumps(obj).encode()
+    if not os.path.exists(filename):
+        with open(filename, "wb") as fp:
+            fp.write(data)
+    elif len(obj) != 0:
+        with open(filename, "r+b") as fp:
+            # Overwrite the closing brace, no separator is needed if the stored object is empty
+            fp.seek(-1, os.SEEK_END)
+            if fp.tell() > 1:
+                fp.write(b",")
+            fp.write(data[1:])
+
+def parseStats(output: str):
+    """ Parses the statistics the NVON Simulator prints at the start of its output.
+        Args:
+            output: standard output of an NVON Simulator run.
+
+        Returns: a dict with the trace file name, total execution time and mean utilization.
+    """
+    traceFile, totalSec, meanUtil = output.split(maxsplit=3)[:3]
+    return {'traceFile': traceFile, 'totalSec': int(totalSec), 'meanUtil': float(meanUtil)}
+
+# Layout of the per window statistics, one record per permutation
+STATS_DTYPE = np.dtype([('id', np.int32), ('totalSec', np.int64), ('meanUtil', np.float64), ('traceFile', object)])
 
 
 def processStats(stats):
     """ Processes statistics regarding a certain permutation window.
         Args:
-            stats: statistcs returned by the NVON Simulator. 
+            stats: (execution id, parsed statistics) tuples returned by spawnProcess. 
 
-        Returns: statistics in a dict data structure.
+        Returns: statistics in a numpy structured array (STATS_DTYPE) ordered by execution id.
     """
-    totalSec = {}
-    meanUtil = {}
-    traceFile = {}
-
-    for stat in stats:
-        id = int(stat[0])
-        totalSec[id]=int(stat[1][1])
-        meanUtil[id]=float(stat[1][2])
-        traceFile[id]=stat[1][0]
-    meanUtil = OrderedDict(sorted(meanUtil.items()))
-    totalSec = OrderedDict(sorted(totalSec.items()))
-    tStats = {}
-    tStats['meanUtil'] = meanUtil
-    tStats['totalSec'] = totalSec
-    tStats['traceFile'] = traceFile
+    tStats = np.array([(id, stat['totalSec'], stat['meanUtil'], stat['traceFile']) for id, stat in stats], dtype=STATS_DTYPE)
+    tStats.sort(order='id')
     return tStats
 
-def getBest(tStats: dict[dict]):
+def getBest(tStats: np.ndarray):
     """ Returns the best performing trace.
         Args:
-            tStats: a dict containing mean utilization, total execution time, and trace-file names
-                    of all permutations in a window.   
+            tStats: a structured array containing execution ids, mean utilization, total execution time,
+                    and trace-file names of all permutations in a window.   
 
         Returns: 
             - best performing trace file name
             - the respective min execution time
             - the first trace that finished its execution in the minimum time
     """
-    totalSec = tStats['totalSec']    
-    mintotalSec = min(totalSec.values())
-    for key, val in totalSec.items():
-        if val == mintotalSec:
-            minTimeRunsPnt = key
-            break 
-    return tStats['traceFile'][minTimeRunsPnt], mintotalSec, minTimeRunsPnt
+    # argmin returns the first occurrence, i.e. the lowest id among equally fast traces
+    best = tStats[int(tStats['totalSec'].argmin())]
+    return best['traceFile'], int(best['totalSec']), int(best['id'])
     
 
-def saveGraphs(graphStats: dict[dict],  pathBatchResults: str, policyName: str, bpoint: int, bTime: int):
+def saveGraphs(graphStats: np.ndarray, utilAx: plt.Axes, timeAx: plt.Axes, pathBatchResults: Path, policyName: str, bpoint: int, bTime: int):
     """ Creates graphs for mean utilization and total execution time. It accounts all permutations in a window.
         Args:
-            graphStats: a dict containing mean utilization, total execution time, and trace-file names
-                        of all permutations in a window. 
+            graphStats: a structured array containing execution ids, mean utilization, total execution time,
+                        and trace-file names of all permutations in a window. 
+            utilAx: axes reused across windows for the mean utilization graph
+            timeAx: axes reused across windows for the total execution time graph
             pathBatchResults: results directory to save the graphs
             policyName: the name of the policy used to get next window (default is best)
             bpoint: the first trace that finished its execution in the minimum time
             bTime: the respective minimun execution time
     """
     # Plot the utilization graph per window run
-    utilPlot = plt.figure(1)
-    plt.plot(graphStats['meanUtil'].keys(),graphStats['meanUtil'].values())
+    utilAx.clear()
+    utilAx.plot(graphStats['id'], graphStats['meanUtil'])
     # Add labels
-    plt.title('Mean utilization')
-    plt.xlabel('Run')
-    plt.ylabel('Utilization')
+    utilAx.set_title('Mean utilization')
+    utilAx.set_xlabel('Run')
+    utilAx.set_ylabel('Utilization')
     # Save to png
-    utilPlot.savefig(pathBatchResults + os.sep + "util_" + policyName + '.png')
-    utilPlot.clear()
+    utilAx.figure.savefig(pathBatchResults / ("util_" + policyName + '.png'))
 
     # Plot the total run time graph per window run
-    totalTimePlot = plt.figure(2)
-    plt.plot(graphStats['totalSec'].keys(), graphStats['totalSec'].values())
-    plt.plot(bpoint,bTime,"o")
-    plt.annotate(bTime,(bpoint,bTime+10))
+    timeAx.clear()
+    timeAx.plot(graphStats['id'], graphStats['totalSec'])
+    timeAx.plot(bpoint,bTime,"o")
+    timeAx.annotate(bTime,(bpoint,bTime+10))
     # Add labels
-    plt.title('Total run time')
-    plt.xlabel('Run')
-    plt.ylabel('Time')
+    timeAx.set_title('Total run time')
+    timeAx.set_xlabel('Run')
+    timeAx.set_ylabel('Time')
     # Save to png
-    totalTimePlot.savefig(pathBatchResults + os.sep + "totalSec_" + policyName + '.png')
-    totalTimePlot.clear()
+    timeAx.figure.savefig(pathBatchResults / ("totalSec_" + policyName + '.png'))
 
 
-def spawnProcess(tracefile: str, initTrace: str, lck: any, stats: list, id: int, pathResults: str): 
+def spawnProcess(tracefile: str, initTrace: str, id: int, pathResults: str, pathOutput: str): 
     """ 
         It spawns an instance of NVONSim Simulator every time is executed.
         Args:
             tracefile: trace file will be used in the simulation
             initTrace: a trace file containing the best permuations of the previous windows
-            lck: lock for protecting the shared statistics list
-            stats: an empy list
             id: execution id
             pathResults: the directory NVSON simulator should use to pesrist the detailed simulation results
+            pathOutput: the window results directory the standard output of the NVON simulator is saved to (sim_<id>.log)
+
+        Returns: a tuple of the execution id and the parsed statistics of the NVON Simulator run.
     """
     exec = []
-    exec = [sys.executable, "main.py","-t",tracefile, "-f", pathResults]
+    exec = [sys.executable, NVON_MAIN,"-t",tracefile, "-f", pathResults]
     if len(initTrace) != 0: 
         exec.append("-i")
         exec.append(initTrace)    
-    result = subprocess.run(exec, stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines=True)
-    print(result.stdout)
-    print(result.stderr)
-    with lck:
-        stats.append((id,result.stdout.split()))
-
-def mycall(_):
-    "Call back function, executed once the worker thread finishes its execution. Left for future use."
-    pass
+    # The simulator output goes straight to a log file instead of through a pipe
+    logFile = os.path.join(pathOutput, "sim_" + str(id) + ".log")
+    with open(logFile, "w") as lfp:
+        result = subprocess.run(exec, stdout = lfp, stderr = subprocess.PIPE, universal_newlines=True)
+    if result.stderr:
+        print(result.stderr)
+    # The statistics lead the output, read only the lines holding them
+    head = ""
+    with open(logFile) as lfp:
+        for line in lfp:
+            head += line
+            if len(head.split(maxsplit=3)) >= 3:
+                break
+    return (id, parseStats(head))
     
 
-def startSim(cores: int, runDir: str, traces: list[str], winInitTrace: str, pathResults: str):
-    """" Creates a pool of worker processes. The processes execute the spawnProcess function for each trace file.
+def pinWorker(freeCores: multiprocessing.Queue):
+    """ Initializer of the pool workers. Pins the worker, and so every NVON simulator it spawns,
+        to a core of its own.
         Args:
+            freeCores: the cores not yet taken by a worker
+    """
+    os.sched_setaffinity(0, {freeCores.get()})
+
+
+def startSim(executor: ProcessPoolExecutor, cores: int, runDir: Path, traces: list[str], winInitTrace: str, pathResults: str, pathOutput: str):
+    """" Executes the spawnProcess function for each trace file on a pool of worker processes.
+        Args:
+            executor: the pool of worker processes, shared by all windows
             cores: the number of the assigned cpu cores
             runDir: corrent working directory
             traces: a list of the trace files in the current window
             wininitTrace: a trace file containing the best permuations of the previous windows
             pathResults: the directory NVSON simulator should use to pesrist the detailed simulation results
+            pathOutput: the window results directory the standard output of every NVON simulator run is saved to
+
+        Returns: a list of (execution id, statistics) tuples, one per trace file.
     """
-    pool = multiprocessing.Pool(cores)
-    mgr = multiprocessing.Manager()
-    lck = mgr.Lock()
-    stats = mgr.list()
-    id = 0
-    for trace in traces:
-        time.sleep(0.5)
-        tracefullname = os.path.join(runDir,trace)
-        pool.apply_async(spawnProcess, (tracefullname, winInitTrace, lck, stats, id, pathResults),callback=mycall)
-        id = id + 1    
-    pool.close()
-    pool.join()
-    return stats
+    tracefullnames = [os.path.join(runDir,trace) for trace in traces]
+    nrTraces = len(tracefullnames)
+    args = (tracefullnames, repeat(winInitTrace, nrTraces), range(nrTraces), repeat(pathResults, nrTraces),
+            repeat(pathOutput, nrTraces))
+    # A single worker or a single trace gains nothing from a pool, run it in this process
+    if cores == 1 or nrTraces == 1:
+        return list(map(spawnProcess, *args))
+    # Every trace is a long simulation, so hand them out one at a time to keep all workers busy
+    return list(executor.map(spawnProcess, *args))
      
 if __name__ == '__main__':
+    # Workers only launch the simulator, so fork them from a server process that has
+    # already imported this module instead of re-importing it (and matplotlib) per worker.
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method('forkserver', force=True)
+        multiprocessing.set_forkserver_preload(['__main__'])
 
     aparser = argparse.ArgumentParser(prog="python nvonsim.py",description='starts execution of multiple instances of the NVON Simulator')
     aparser.add_argument("-t", "--traces", required=True, help="path to traces directory")
     aparser.add_argument("-n","--procs", type=int, default=4, help="number of running NVON simulator instances (default 4)")
+    aparser.add_argument("--no-plots", action="store_true", help="do not save the per window graphs")
     args = aparser.parse_args()
 
+    if not os.path.exists(NVON_MAIN):
+        sys.exit("NVON Simulator (" + NVON_MAIN + ") not found in the working directory. Execution aborted...")
+
     policyName = "best"  
 
     # Create run-time directory structure
     # All run-time files are stored in the 'run' directory 
     runTime = datetime.datetime.now().strftime("%d%m%Y.%H%M%S")
-    runDir = 'run' + os.sep + 'run_' + runTime + "_" + policyName
-    os.mkdir(runDir)
+    runDir = Path('run') / ('run_' + runTime + "_" + policyName)
+    runDir.mkdir()
     print("Creating directory: ",runDir)
     # Log files directory, contains results from every NVON Simulator run
-    logs = runDir + os.sep + 'logs'    
+    logs = runDir / 'logs'
     # Create directory for results (window)
-    results = runDir + os.sep + 'results'
-    os.mkdir(results)
+    results = runDir / 'results'
+    results.mkdir()
     print("Creating directory: ", results)
     # Create directory for intermediate workloads (window history) 
-    tmp = runDir + os.sep + 'tmp'
-    os.mkdir(tmp)
+    tmp = runDir / 'tmp'
+    tmp.mkdir()
     print("Creating directory: ", tmp)
     
     if not os.path.exists(args.traces):
         sys.exit("Traces list file does not exist. Execution aborted...")
     traces_dir = args.traces.split('\\').pop()
-    tracesPath = runDir + os.sep + traces_dir
+    # Absolute trace paths are still copied under the run directory
+    tracesPath = runDir / traces_dir.lstrip(os.sep)
     print("Trace files will be stored in: ",tracesPath)
     print("Copying trace files...")
     shutil.copytree(args.traces, tracesPath)  
     
     # get workload definiton
-    if os.path.exists(tracesPath + os.sep + 'workload.json'):
-            with open(tracesPath + os.sep + 'workload.json') as json_file:
-                workloadInfo = json.load(json_file)
+    workloadFile = tracesPath / 'workload.json'
+    if workloadFile.exists():
+            workloadInfo = loadJson(workloadFile)
 
     else:
         sys.exit("Workload definition file (workload.json) not found. Exitting ...")
@@ -185,88 +253,90 @@ if __name__ == '__main__':
     stats = []
 
     winInitTracesFile = ""
+    if not args.no_plots:
+        # Figures are created once and redrawn for every window
+        _, utilAx = plt.subplots()
+        _, timeAx = plt.subplots()
+        # Graphs of a window are saved in the background while the next window is simulated
+        graphsExecutor = ThreadPoolExecutor(max_workers=1)
+    # Worker processes are started once and reused by all windows.
+    # Where supported, every worker is pinned to its own core to keep the caches of its simulations warm.
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        freeCores = multiprocessing.Queue()
+        for worker in range(args.procs):
+            freeCores.put(cpus[worker % len(cpus)])
+        simExecutor = ProcessPoolExecutor(max_workers=args.procs, initializer=pinWorker, initargs=(freeCores,))
+    else:
+        simExecutor = ProcessPoolExecutor(max_workers=args.procs)
     
     ## Process the first window
     # Initialize
     print("\n processing window: 0")
-    traceList = os.path.join(tracesPath + os.sep + workloadInfo['winDirPrefix'] + str(0) + os.sep + 'job_permut_list.txt')
-    with open(traceList) as fp:
-        traces = fp.readlines()      
-    traces = [x.strip() for x in traces]    
-    winResults = results + os.sep + workloadInfo['winDirPrefix'] + str(0)
-    os.mkdir(winResults)
-    winLogs = logs + os.sep + workloadInfo['winDirPrefix'] + str(0)
+    winDir = workloadInfo['winDirPrefix'] + str(0)
+    with (tracesPath / winDir / 'job_permut_list.txt').open() as fp:
+        traces = fp.read().splitlines()
+    winResults = results / winDir
+    winResults.mkdir()
+    winLogs = logs / winDir
     # Start simulation. Run simulations for all traces (permutations) of the first window.
-    stats = startSim(args.procs, runDir, traces, "", os.path.abspath(winLogs))
+    stats = startSim(simExecutor, args.procs, runDir, traces, "", os.path.abspath(winLogs), str(winResults))
     print("Simulation finished. Saving results....")
     # Process results
     traceStats = processStats(stats)
     bestTrace, bTime, bpoint = getBest(traceStats)         
     print("Best performing trace file is: ", bestTrace, bTime, bpoint)    
-    with open(results + os.sep + "win_0" + os.sep +'win_0_'+ policyName +'.log', "w") as wfp:
+    with (winResults / ('win_0_' + policyName + '.log')).open("w") as wfp:
         log = '\n'.join(str(ln) for ln in stats)        
         log = log + "\nBest performing trace file is: " + str(bestTrace) + " time: " + str(bTime)
         wfp.write(log)
-    saveGraphs(traceStats, winResults, policyName, bpoint, bTime)
+    if not args.no_plots:
+        graphsFuture = graphsExecutor.submit(saveGraphs, traceStats, utilAx, timeAx, winResults, policyName, bpoint, bTime)
     # Pick the best performing window and use it as seed for the next simulation
-    nextWinInitTraces = {}   
+    # The seed file is shared by all windows, every window only appends its best trace
+    winInitTraceFile = str(tmp / "winInitTrace.json")
     if os.path.exists(bestTrace):
-        with open(bestTrace) as btf1:
-            nextWinInitTraces = json.load(btf1)
+        appendJson(loadJson(bestTrace), winInitTraceFile)
     else:
         print("windows initialization traces file not found",bestTrace)
         exit(-2)
-    nextWinInitTraceFile = tmp+os.sep+"winInitTrace_"+str(1)+".json"
-    with open(nextWinInitTraceFile, "w") as output_file:
-        json.dump(nextWinInitTraces, output_file)
 
     
     ## Process next windows    
     for i in range(1, workloadInfo['nrWindows']):
         # Initialize
         print("\n processing window: ",i)
-        traceList = os.path.join(tracesPath + os.sep + workloadInfo['winDirPrefix'] + str(i) + os.sep + 'job_permut_list.txt')
-        with open(traceList) as fp:
-            traces = fp.readlines()      
-        traces = [x.strip() for x in traces]
-        winResults = results + os.sep + workloadInfo['winDirPrefix'] + str(i)
+        winDir = workloadInfo['winDirPrefix'] + str(i)
+        with (tracesPath / winDir / 'job_permut_list.txt').open() as fp:
+            traces = fp.read().splitlines()
+        winResults = results / winDir
         print(winResults)
-        os.mkdir(winResults)
-        winLogs = logs + os.sep + workloadInfo['winDirPrefix'] + str(i)
+        winResults.mkdir()
+        winLogs = logs / winDir
         # Start simulation. Run simulations for all traces (permutations) of the current window.
-        stats = startSim(args.procs, runDir, traces, nextWinInitTraceFile, os.path.abspath(winLogs))
+        stats = startSim(simExecutor, args.procs, runDir, traces, winInitTraceFile, os.path.abspath(winLogs), str(winResults))
         print("Simulation finished. Saving results....")
         # Process results
-        prevWinInitTracesFile = nextWinInitTraceFile
         traceStats = processStats(stats)
         bestTrace, bTime, bpoint = getBest(traceStats)
         print("Best performing trace file is: ", bestTrace, bTime, bpoint)
-        with open(results + os.sep + "win_" + str(i) + os.sep + 'win_' + str(i) + '_' + policyName + '.log', "w") as wfp:
+        with (winResults / ('win_' + str(i) + '_' + policyName + '.log')).open("w") as wfp:
             log = '\n'.join(str(ln) for ln in stats)           
             log = log + "\nBest performing trace file is: " + str(bestTrace) + " time: " + str(bTime)
             wfp.write(log)
-        saveGraphs(traceStats, winResults, policyName, bpoint, bTime)
+        if not args.no_plots:
+            # The figures are reused, wait for the previous window's graphs first
+            graphsFuture.result()
+            graphsFuture = graphsExecutor.submit(saveGraphs, traceStats, utilAx, timeAx, winResults, policyName, bpoint, bTime)
         ## Prepare seed for the next simulation
-        # First retrieve all previous windows used as seed in the current simulation
-        prevWinInitTraces = {}
-        nextWinInitTraces = {}        
-        if os.path.exists(prevWinInitTracesFile):
-            with open(prevWinInitTracesFile) as wtr:
-                prevWinInitTraces = json.load(wtr)
-        else:
-            print("Previous window initialivation traces file not found",prevWinInitTracesFile)
-            exit(-1)
-        # Pick the best performing window in the current simulation
+        # Append the best performing window in the current simulation to the previous windows
         if os.path.exists(bestTrace):
-            with open(bestTrace) as btf1:
-                nextWinInitTraces = json.load(btf1)
+            appendJson(loadJson(bestTrace), winInitTraceFile)
         else:
             print("best traces file not found",bestTrace)
             exit(-2)
-        # Concatenate previous and current windows as seed for the next simulation 
-        prevWinInitTraces.update(nextWinInitTraces)
-        nextWinInitTraces = prevWinInitTraces
-        nextWinInitTraceFile = tmp+os.sep+"winInitTrace_"+str(i+1)+".json"
-        with open(nextWinInitTraceFile, "w") as output_file:
-            json.dump(nextWinInitTraces, output_file)
-    
\ No newline at end of file
+
+    simExecutor.shutdown()
+    if not args.no_plots:
+        graphsFuture.result()
+        graphsExecutor.shutdown()